@@ -1,7 +1,81 @@
 import numpy as np
-import beamq
-import component
+from beamq import beamq
+from component import componentList
 from copy import deepcopy
+from bisect import bisect_right
+
+
+def _zvalue(comp):
+
+    # components built with the list style constructors (component.lens,
+    # component.curvedMirror) store their position as a one element list.
+
+    z = comp.z
+    if isinstance(z, list):
+        z = z[0]
+    return z
+
+
+# ABCD matrices inside the propagation cache are kept as (A,B,C,D) tuples of
+# floats, which is much faster than np.matrix for 2x2 products.
+
+def _matrixTuple(M):
+
+    return (M.item(0,0), M.item(0,1), M.item(1,0), M.item(1,1))
+
+
+def _matmul(P, Q):
+
+    # the product P*Q
+    return (P[0]*Q[0]+P[1]*Q[2], P[0]*Q[1]+P[1]*Q[3],
+            P[2]*Q[0]+P[3]*Q[2], P[2]*Q[1]+P[3]*Q[3])
+
+
+def _matinv(P):
+
+    # closed form inverse from the 2x2 determinant
+    det = P[0]*P[3]-P[1]*P[2]
+    return (P[3]/det, -P[1]/det, -P[2]/det, P[0]/det)
+
+
+def _propagate(P, dz):
+
+    # free space propagation by dz after P, i.e. [[1,dz],[0,1]]*P
+    return (P[0]+dz*P[2], P[1]+dz*P[3], P[2], P[3])
+
+
+_identity = (1., 0., 0., 1.)
+
+
+def _nondominated(F, block = 256):
+
+    # Boolean mask of the rows of F (candidates x 3 objectives, all minimized)
+    # which no other row dominates; of identical rows only the first is kept.
+    # Candidates are visited in lexicographic order, so everything already on
+    # the front beats them on the first objective and the test reduces to a
+    # staircase lookup on the other two: the front is kept sorted by the second
+    # objective with a running minimum of the third.
+
+    order = np.lexsort(F.T[::-1])
+    Fs = F[order]
+    keep = np.zeros(len(F), dtype = bool)
+    front = np.empty((0, 2))
+    stair = np.empty(0)
+
+    for start in range(0, len(Fs), block):
+        cand = Fs[start:start+block, 1:]
+        i = np.searchsorted(front[:, 0], cand[:, 0], 'right')
+        ok = (i == 0) | (stair[np.maximum(i-1, 0)] > cand[:, 1]) if len(front) else np.ones(len(cand), dtype = bool)
+        # earlier members of the same block
+        ok &= ~np.any(np.tril(np.all(cand <= cand[:, None, :], axis = 2), -1), axis = 1)
+        keep[order[start:start+block]] = ok
+
+        front = np.concatenate([front, cand[ok]])
+        front = front[np.argsort(front[:, 0], kind = 'stable')]
+        stair = np.minimum.accumulate(front[:, 1])
+
+    return keep
+
 
 class beamPath(object):
 
@@ -44,15 +118,21 @@ class beamPath(object):
     """
 
 
-    def __init__ (self, seedq, seedz, targetq, targetz):
+    def __init__ (self, seedq, seedz, targetq, targetz, components = None):
 
-        self.seedq = beamq
-        self.seedz = []
-        self.targetq = beamq
-        self.targetz = []
-            
-        self.components_raw = component            
-        #self.components_raw[1]=[]  #empty the component list
+        self._version = 0
+        self.parent = None
+        self._parentVersion = None
+        self.invalidate()
+
+        self.seedq = seedq
+        self.seedz = seedz
+        self.targetq = targetq
+        self.targetz = targetz
+
+        if components is None:
+            components = []
+        self.components_raw = componentList(components)
 
 
 
@@ -129,6 +209,8 @@ class beamPath(object):
         # -- beamPath.duplicate --
         #
         #    Creates a new beampath with the same properties as the original.
+        #    A path linked to a parent (see set_parent) is copied without its
+        #    parent: the copy stays linked to the same, live parent path.
         #    Example:
         #    path1copy = path1.duplicate
 
@@ -136,6 +218,19 @@ class beamPath(object):
 
 
 
+    def __deepcopy__(self, memo):
+
+        # everything but the parent path is copied, so copying an arm of a
+        # pathNetwork does not copy the trunk and its other arms
+        path2 = beamPath.__new__(beamPath)
+        memo[id(self)] = path2
+        for key, value in self.__dict__.items():
+            path2.__dict__[key] = value if key == 'parent' else deepcopy(value, memo)
+
+        return path2
+
+
+
     def branchPath(self, zlink):
 
         # -- beamPath.branchPath --
@@ -152,26 +247,197 @@ class beamPath(object):
         #    syntax: path2 = path1.branchPath(zlink)
         #    zlink is the position of the beam you would like to be the seed beam of 
         #    the new path.
+        #    The ABCD products cached in the calling path are carried over
+        #    (re-referenced to zlink through the inverse product at zlink), so
+        #    the new path does not repeat any propagation.
 
         qlink = self.qPropagate(zlink)
-        self = self.duplicate()
+        L = _matrixTuple(self.transferMatrix(zlink, inverse = True))
+        Linv = _matrixTuple(self.transferMatrix(zlink))
 
-        self.seedq = qlink
-        self.seedz = zlink
+        zb, Pb, Pinvb, zhead, Phead, Pinvhead = self.boundaryMatrices()
+        comps = self.components
+
+        path2 = self.duplicate()
+        path2.seedq = qlink
+        path2.seedz = zlink
+
+        zlist = self._zlist
+        nup = bisect_right(zlist, zlink)
+        # the new seed to just after component j is Pb[j]*L, and its inverse 
+        # Linv*Pinvb[j]
+        Pafter = [_matmul(tuple(Pb[j].ravel()), L) for j in range(len(comps))]
+        Pafterinv = [_matmul(Linv, tuple(Pinvb[j].ravel())) for j in range(len(comps))]
+
+        path2._fwd = [(zlist[j], Pafter[j], Pafterinv[j]) for j in range(nup, len(comps))]
+        path2._bwd = []
+        for j in range(nup-1, -1, -1):
+            M = _matrixTuple(comps[j].M)
+            path2._bwd.append((zlist[j], Pafter[j], Pafterinv[j],
+                               _matmul(_matinv(M), Pafter[j]), _matmul(Pafterinv[j], M)))
+        path2._sorted = True
+        path2._zlist = list(zlist)
+
+        return path2
 
 
 
     def set_components(self, comps):
 
         self.components_raw = comps
+        self.invalidate()
+
+        return self
+
+
+    @property
+    def seedq(self):
+
+        # a path linked to a parent takes its seed beam from the parent at
+        # seedz, refreshed only when the parent has changed
+        if self.parent is not None:
+            v = self.parent.stateVersion
+            if v != self._parentVersion:
+                self._seedq = self.parent.qPropagate(self._seedz)
+                self._parentVersion = v
+                self._boundary = None
+
+        return self._seedq
+
+    @seedq.setter
+    def seedq(self, qin):
+
+        # setting the seed beam explicitly detaches the path from its parent.
+        # The cached ABCD products do not depend on the seed beam.
+        self.parent = None
+        self._seedq = qin
+        self._version += 1
+        self._boundary = None
+
+
+    @property
+    def seedz(self):
+
+        return self._seedz
+
+    @seedz.setter
+    def seedz(self, zin):
+
+        self._seedz = zin
+        self._parentVersion = None
+        self.invalidate()
+
+
+
+    def set_parent(self, parentPath, zlink):
+
+        # -- beamPath.set_parent --
+        #
+        #    Links this path to a parent path: the seed beam becomes the beam of
+        #    parentPath at zlink, and seedz becomes zlink. The parent's beam is
+        #    looked up from its cache whenever the parent changes, so shared 
+        #    upstream propagation is done once for all the paths linked to it,
+        #    and edits to this path do not affect the parent or its other 
+        #    children. See pathNetwork.py.
+        #    Example:
+        #    arm1 = beamPath(None, 0, target, 1.5, [component.lens([0.2],[0.9],['arm1lens'])])
+        #    arm1.set_parent(trunk, 0.6)
+
+        self.seedz = zlink
+        self.parent = parentPath
+        self._parentVersion = None
 
         return self
 
 
+    @property
+    def stateVersion(self):
+
+        # changes whenever the beam anywhere in this path may have changed
+        if self.parent is None:
+            return self._version
+
+        return (self._version, self.parent.stateVersion)
+
+
+
+    def invalidate(self, zlo = -np.inf, zhi = np.inf):
+
+        # -- beamPath.invalidate --
+        #
+        #    Discards the cached propagation results which depend on components
+        #    between zlo and zhi. By default the whole cache is dropped.
+        #    The component editing methods of beamPath call this themselves;
+        #    call it directly after changing a component object (its z or M)
+        #    by hand.
+        #    The cache holds the ABCD product from the seed to every component
+        #    boundary, together with its inverse: _fwd for components 
+        #    downstream of the seed, in increasing z, and _bwd for those at or
+        #    upstream of the seed, in decreasing z. An edit between zlo and zhi
+        #    only affects forward entries at or beyond zlo, and only if the
+        #    edit reaches downstream of the seed; likewise backward entries at
+        #    or before zhi, only if the edit reaches the seed or upstream of it.
+        #    So an edit on one side of the seed keeps the other side's cache,
+        #    and a move across the seed drops the affected entries on both.
+        #    Either way the component list is marked for re-sorting, since a
+        #    component changed by hand may have moved.
+
+        if zlo == -np.inf and zhi == np.inf:
+            self._fwd = []
+            self._bwd = []
+
+        self._sorted = False
+        self._labels = None
+        self._zlist = None
+        self._dropCache(zlo, zhi)
+
+
+
+    def _dropCache(self, zlo, zhi):
+
+        # The partial part of invalidate, for editing methods which keep the
+        # component order and _zlist up to date themselves (moveComponent).
+
+        if self._fwd and zhi > self.seedz:
+            while self._fwd and self._fwd[-1][0] >= zlo:
+                self._fwd.pop()
+        if self._bwd and zlo <= self.seedz:
+            while self._bwd and self._bwd[-1][0] <= zhi:
+                self._bwd.pop()
+
+        self._version += 1
+        self._head = None
+        self._matrices = None
+        self._boundary = None
+
+
     @property
     def components(self):
 
-        self.sortComponents
+        if not self._sorted:
+            self.sortComponents()
+        return self.components_raw
+
+
+
+    def sortComponents(self):
+
+        # -- beamPath.sortComponents --
+        #
+        #    Orders the component list by increasing z position. The sort is
+        #    stable, so components sharing a position keep the order in which
+        #    they were added to the path.
+
+        comps = self.components_raw
+        zlist = [_zvalue(c) for c in comps]
+        zindex = sorted(range(len(comps)), key = zlist.__getitem__)
+
+        if zindex != list(range(len(comps))):
+            self.components_raw = componentList([comps[j] for j in zindex])
+            self._labels = None
+            self._zlist = None
+
+        self._sorted = True
         return self.components_raw
 
 
@@ -196,7 +462,10 @@ class beamPath(object):
         #    mylens = component.lens(2,0,'mylens')
         #    path1.addComponent(mylens)
 
-        self.components = self.components.append(newComponent)
+        self.components_raw.append(newComponent)
+
+        znew = _zvalue(newComponent)
+        self.invalidate(znew, znew)
 
 
 
@@ -209,7 +478,9 @@ class beamPath(object):
         #    path1.deleteComponent('mylens');
             
         delIndex = self.findComponentIndex(delLabel)
+        zdel = _zvalue(self.components[delIndex-1])
         del self.components[delIndex-1]
+        self.invalidate(zdel, zdel)
             
         return self.components
 
@@ -230,13 +501,26 @@ class beamPath(object):
 
         componentIndex = self.findComponentIndex(componentLabel)
             
-        componentToMove = self.components(componentIndex)
-        zstart = componentToMove.z
+        componentToMove = self.components[componentIndex-1]
+        zstart = _zvalue(componentToMove)
 
         if isabsolute == 'absolute':
             displacement = displacement - zstart
 
         componentToMove.z = zstart + displacement
+        znew = componentToMove.z
+
+        # the list only needs re-sorting if the component passed a neighbour
+        comps = self.components_raw
+        if (componentIndex > 1 and _zvalue(comps[componentIndex-2]) > znew) \
+        or (componentIndex < len(comps) and _zvalue(comps[componentIndex]) < znew):
+            self._sorted = False
+            self._labels = None
+            self._zlist = None
+        elif self._zlist is not None:
+            self._zlist[componentIndex-1] = float(znew)
+
+        self._dropCache(min(zstart, znew), max(zstart, znew))
 
 
 
@@ -254,9 +538,9 @@ class beamPath(object):
 
         componentIndex = self.findComponentIndex(componentLabel)
             
-        newComponent.z = self.components(componentIndex).z
-        newComponent.label = self.components(componentIndex).label            
-        self.deleteComponent(componentIndex)
+        newComponent.z = self.components[componentIndex-1].z
+        newComponent.label = self.components[componentIndex-1].label            
+        self.deleteComponent(componentLabel)
         self.addComponent(newComponent)
 
 
@@ -282,7 +566,7 @@ class beamPath(object):
 
         componentIndex = self.findComponentIndex(componentLabel)
             
-        return self.components(componentIndex)
+        return self.components[componentIndex-1]
 
 
 
@@ -297,26 +581,605 @@ class beamPath(object):
         #     path1.findComponentIndex('goodlens')
         #     This statement would return the number 4.
 
+        comps = self.components
+
+        if self._labels is None:
+            self._labels = {}
+            for j in range(len(comps)):
+                self._labels.setdefault(getattr(comps[j], 'label', None), j+1)
+
+        if componentLabel in self._labels:
+            return self._labels[componentLabel]
+
+        raise Exception ("No component labelled '%s' in this beam path." % componentLabel)
+
+
+
+    def findSegment(self, z):
+
+        #  -- beamPath.findSegment --
+        #
+        #     Returns the (zero based) index of the last component at or upstream 
+        #     of each position in z, or -1 for positions upstream of every 
+        #     component. A beam at the same position as a component is taken to
+        #     be just downstream of it.
+
+        zlist = self._extendCache()
+
+        if np.ndim(z) == 0:
+            return bisect_right(zlist, z) - 1
+
+        return np.searchsorted(zlist, z, side = 'right') - 1
 
 
 
+    @staticmethod
+    def inverseMatrix(M):
 
+        #  -- beamPath.inverseMatrix --
+        #
+        #     Returns the inverse of a 2x2 ABCD matrix, used to propagate a beam
+        #     backwards through a component. Computed in closed form from the
+        #     determinant.
+
+        return np.matrix(np.reshape(_matinv(_matrixTuple(M)), (2,2)))
+
+
+
+    def boundaryMatrices(self):
+
+        #  -- beamPath.boundaryMatrices --
+        #
+        #     Returns (zb, Pb, Pinvb, zhead, Phead, Pinvhead) where zb is the 
+        #     array of component positions, Pb[j] the 2x2 ABCD matrix which 
+        #     takes the seed beam to just downstream of component j, Pinvb[j]
+        #     its inverse, and Phead the matrix which takes the seed beam to 
+        #     zhead, a point upstream of every component (the position of the
+        #     first component, or the seed position if no component is upstream
+        #     of the seed), with inverse Pinvhead.
+        #     Components downstream of the seed are multiplied in forwards, 
+        #     those upstream of (or at) the seed through their inverses, which
+        #     are taken in closed form from the 2x2 determinant. Each product
+        #     is cached together with its inverse, and only the part of the
+        #     path invalidated by edits since the last call is recomputed (see
+        #     beamPath.invalidate).
+
+        if self._matrices is not None:
+            return self._matrices
+
+        zlist = self._extendCache()
+        zhead, Phead, Pinvhead = self._head
+        fwd, bwd = self._fwd, self._bwd
+
+        zb = np.array(zlist)
+        Pall = np.array([e[1]+e[2] for e in bwd[::-1]] + [e[1]+e[2] for e in fwd], dtype = float)
+        Pall = Pall.reshape(len(zlist), 2, 2, 2)
+
+        self._matrices = (zb, Pall[:,0], Pall[:,1], zhead,
+                          np.array(Phead).reshape(2,2), np.array(Pinvhead).reshape(2,2))
+        return self._matrices
+
+
+
+    def _extendCache(self):
+
+        # Recomputes the cache entries dropped by invalidate (see 
+        # boundaryMatrices) and returns the sorted list of component positions.
+
+        zlist = self._zlist
+        if zlist is not None and self._head is not None:
+            return zlist
+
+        comps = self.components
+        ncomps = len(comps)
+        if zlist is None:
+            zlist = self._zlist = [float(_zvalue(c)) for c in comps]
+
+        # components at or upstream of the seed
+        nup = self._nup = bisect_right(zlist, self.seedz)
+
+        # forward products, from the last cached boundary. 
+        # Entries are (z, P, inverse of P).
+        fwd = self._fwd
+        if fwd:
+            zprev, P, Pinv = fwd[-1]
+        else:
+            zprev, P, Pinv = self.seedz, _identity, _identity
+        for j in range(nup+len(fwd), ncomps):
+            M = _matrixTuple(comps[j].M)
+            dz = zlist[j]-zprev
+            P = _matmul(M, _propagate(P, dz))
+            Pinv = _matmul(Pinv, _propagate(_matinv(M), -dz))
+            fwd.append((zlist[j], P, Pinv))
+            zprev = zlist[j]
+
+        # backward products, from the last cached boundary.
+        # Entries are (z, P just after the component, its inverse, 
+        # P just before the component, its inverse).
+        bwd = self._bwd
+        if bwd:
+            zprev, Pafter, Pafterinv, P, Pinv = bwd[-1]
+        else:
+            zprev, P, Pinv = self.seedz, _identity, _identity
+        for j in range(nup-1-len(bwd), -1, -1):
+            M = _matrixTuple(comps[j].M)
+            dz = zlist[j]-zprev
+            Pafter = _propagate(P, dz)
+            Pafterinv = _matmul(Pinv, (1., -dz, 0., 1.))
+            P = _matmul(_matinv(M), Pafter)
+            Pinv = _matmul(Pafterinv, M)
+            bwd.append((zlist[j], Pafter, Pafterinv, P, Pinv))
+            zprev = zlist[j]
+
+        self._head = (zprev, P, Pinv)
+        return zlist
+
+
+
+    def transferMatrix(self, z, inverse = False):
+
+        #  -- beamPath.transferMatrix --
+        #
+        #     Returns the ABCD matrix which takes the seed beam (at seedz) to
+        #     position z, upstream or downstream of the seed. With 
+        #     inverse = True, returns the matrix which takes a beam at z back
+        #     to seedz. For an array of positions the result is an array of 
+        #     shape z.shape + (2,2); for a single position it is an np.matrix.
+        #     Example:
+        #     qt = beamq.transformValue(path1.targetq.q, path1.transferMatrix(path1.targetz, True))
+        #     This is the target beam referred back to the seed position.
+
+        zb, Pb, Pinvb, zhead, Phead, Pinvhead = self.boundaryMatrices()
+
+        seg = np.asarray(self.findSegment(z))
+        zarr = np.asarray(z, dtype = float)
+
+        if inverse:
+            Pb, Phead = Pinvb, Pinvhead
+
+        if len(zb) > 0:
+            segc = np.clip(seg, 0, None)
+            P = np.where((seg >= 0)[...,None,None], Pb[segc], Phead)
+            dz = zarr - np.where(seg >= 0, zb[segc], zhead)
+        else:
+            P = np.broadcast_to(Phead, zarr.shape+(2,2))
+            dz = zarr - zhead
+
+        Pz = np.array(P)
+        if inverse:
+            # the inverse of [[1,dz],[0,1]]*P is Pinv*[[1,-dz],[0,1]]
+            Pz[...,0,1] -= dz*P[...,0,0]
+            Pz[...,1,1] -= dz*P[...,1,0]
+        else:
+            # free space from the boundary to z: [[1,dz],[0,1]]*P
+            Pz[...,0,0] += dz*P[...,1,0]
+            Pz[...,0,1] += dz*P[...,1,1]
+
+        if Pz.ndim == 2:
+            return np.matrix(Pz)
+        return Pz
+
+
+
+    def boundaryQ(self):
+
+        #  -- beamPath.boundaryQ --
+        #
+        #     Returns (zb, qb, zhead, qhead): zb is the array of component 
+        #     positions, qb the q value just downstream of each component, and
+        #     qhead the q value at zhead, a point upstream of every component.
+        #     The q values are the seed beam transformed by the cached ABCD 
+        #     products of beamPath.boundaryMatrices, so changing only the seed
+        #     beam does not repeat any matrix products.
+
+        q0 = self.seedq.q
+
+        if self._boundary is not None:
+            return self._boundary
+
+        zb, Pb, Pinvb, zhead, Phead, Pinvhead = self.boundaryMatrices()
+
+        qb = (Pb[:,0,0]*q0+Pb[:,0,1])/(Pb[:,1,0]*q0+Pb[:,1,1])
+        qhead = complex((Phead[0,0]*q0+Phead[0,1])/(Phead[1,0]*q0+Phead[1,1]))
+
+        self._boundary = (zb, qb, zhead, qhead)
+        return self._boundary
+
+
+
+    def qPropagate(self, z):
+
+        #  -- beamPath.qPropagate --
+        #
+        #     Propagates the seed beam to the position(s) z and returns a beamq
+        #     object. z may be a single position or a list/array of positions, 
+        #     in which case the q property of the returned beamq is an array 
+        #     with the same shape as z.
+        #     Example:
+        #     q1 = path1.qPropagate(0.5)
+        #     w = path1.qPropagate(np.linspace(0,1,100)).beamWidth
+
+        seg = self.findSegment(z)
+
+        if np.ndim(z) == 0:
+            # single position, straight from the cached products
+            if seg < 0:
+                zprev, P = self._head[0], self._head[1]
+            elif seg < self._nup:
+                zprev, P = self._bwd[self._nup-1-seg][:2]
+            else:
+                zprev, P = self._fwd[seg-self._nup][:2]
+            A, B, C, D = _propagate(P, z-zprev)
+            q0 = self.seedq.q
+            return beamq((A*q0+B)/(C*q0+D), self.seedq.wavelength, self.seedq.M2)
+
+        zb, qb, zhead, qhead = self.boundaryQ()
+
+        zarr = np.asarray(z, dtype = float)
+
+        if len(zb) > 0:
+            segc = np.clip(seg, 0, None)
+            qout = np.where(seg >= 0, qb[segc] + (zarr-zb[segc]), qhead + (zarr-zhead))
+        else:
+            qout = qhead + (zarr-zhead) + 0j
+
+        return beamq(qout, self.seedq.wavelength, self.seedq.M2)
+
+
+
+    def propagateEnsemble(self, positions, z = None, labels = None, dtype = np.float64,
+                          maxBytes = 2**26, check = 100, rtol = 1e-4):
+
+        #  -- beamPath.propagateEnsemble --
+        #
+        #     Propagates the seed beam through many variants of the path at once,
+        #     e.g. for tolerance analysis or position scans. positions is an
+        #     array of shape (samples, len(labels)) giving the z position of
+        #     each labelled component in each sample; components which are not
+        #     listed stay where they are (labels defaults to every component,
+        #     in order of z). z is the output position, a number or an array with
+        #     one entry per sample, and defaults to targetz. Returns a beamq
+        #     with an array of q values, one per sample, which matches
+        #     qPropagate on the corresponding path.
+        #
+        #     Samples are processed in chunks so that the intermediate arrays
+        #     of each chunk, (samples x components x 2 x 2) step and product
+        #     matrices, stay within maxBytes. With dtype = np.float32 these are
+        #     stored in single precision and the q values returned as
+        #     complex64. The result is then checked against a float64
+        #     calculation of 'check' samples spread over the ensemble, and an
+        #     exception is raised if the relative error in q exceeds rtol.
+        #     Example:
+        #     pos = nominal + 1e-3*np.random.randn(10**6, 2)
+        #     q = path1.propagateEnsemble(pos, labels = ['lens1','lens2'], dtype = np.float32)
+        #     eta = path1.targetq.overlap(q, path1.targetq)
+
+        comps = self.components
+        ncomps = len(comps)
+
+        # every component, by position in the sorted list, so unlabelled
+        # components (which all share 'no label') are told apart
+        if labels is None:
+            moved = list(range(ncomps))
+        else:
+            moved = [self.findComponentIndex(label)-1 for label in labels]
+            if len(set(moved)) != len(moved):
+                raise Exception ("Each component can only be moved once; labels %s are not unique in this beam path."
+                                 % list(labels))
+
+        positions = np.asarray(positions, dtype = float)
+        positions = positions.reshape(positions.shape[0], len(moved))
+        nsamples = positions.shape[0]
+
+        if z is None:
+            z = self.targetz
+        z = np.broadcast_to(np.asarray(z, dtype = float), (nsamples,))
+
+        dtype = np.dtype(dtype)
+        qout = np.empty(nsamples, dtype = np.result_type(dtype, np.complex64))
 
+        # per sample: positions, sort order, step matrices and temporaries
+        bytesPerSample = ncomps*(3*8 + 12*dtype.itemsize) + 32*dtype.itemsize
+        chunk = max(int(maxBytes // bytesPerSample), 1)
 
+        for start in range(0, nsamples, chunk):
+            stop = min(start+chunk, nsamples)
+            qout[start:stop] = self._ensembleChunk(positions[start:stop], z[start:stop],
+                                                   moved, dtype)
 
+        if dtype != np.float64 and check > 0 and nsamples > 0:
+            idx = np.unique(np.linspace(0, nsamples-1, min(check, nsamples)).astype(int))
+            qref = self._ensembleChunk(positions[idx], z[idx], moved, np.dtype(np.float64))
+            err = np.max(np.abs(qout[idx]-qref)/np.abs(qref))
+            if err > rtol:
+                raise Exception ("Relative error %g of %s ensemble exceeds rtol = %g, use dtype = np.float64."
+                                 % (err, dtype.name, rtol))
 
+        return beamq(qout, self.seedq.wavelength, self.seedq.M2)
 
 
 
+    def _ensembleChunk(self, moves, zout, moved, dtype):
 
+        # q at zout for each row of component positions in moves, see
+        # propagateEnsemble. Each sample uses the components in (a, b],
+        # a = min(zout, seedz), b = max(zout, seedz), multiplied forwards
+        # from a to b; the result is inverted when zout is upstream of the seed.
 
+        comps = self.components
+        nsamples = moves.shape[0]
 
+        pos = np.empty((nsamples, len(comps)))
+        pos[:] = [_zvalue(c) for c in comps]
+        pos[:, moved] = moves
+
+        order = np.argsort(pos, axis = 1, kind = 'stable')
+        pos = np.take_along_axis(pos, order, axis = 1)
+        Ms = np.array([c.M for c in comps], dtype = dtype).reshape(len(comps), 2, 2)[order]
+
+        seedz = self.seedz
+        a = np.minimum(zout, seedz)[:, None]
+        b = np.maximum(zout, seedz)[:, None]
+        inc = (pos > a) & (pos <= b)
+
+        # previous included position for every component (a if there is none)
+        zprev = np.concatenate([a, np.where(inc, pos, -np.inf)[:, :-1]], axis = 1)
+        zprev = np.maximum.accumulate(np.maximum(zprev, a), axis = 1)
+        dz = np.where(inc, pos-zprev, 0).astype(dtype)
+
+        # step j is M_j*[[1,dz],[0,1]], or the identity for excluded components
+        steps = Ms
+        steps[..., 0, 1] = Ms[..., 0, 0]*dz + Ms[..., 0, 1]
+        steps[..., 1, 1] = Ms[..., 1, 0]*dz + Ms[..., 1, 1]
+        steps[~inc] = np.eye(2, dtype = dtype)
+
+        F = componentList.combineBatch(steps, dtype)
+        # last included position, or a (also for a path with no components)
+        zlast = np.maximum(np.max(np.where(inc, pos, a), axis = 1, initial = -np.inf), a[:, 0])
+        F[:, 0, 0] += (b[:, 0]-zlast).astype(dtype)*F[:, 1, 0]
+        F[:, 0, 1] += (b[:, 0]-zlast).astype(dtype)*F[:, 1, 1]
+
+        # upstream of the seed: closed form inverse
+        back = zout < seedz
+        if np.any(back):
+            Fb = F[back]
+            det = Fb[:, 0, 0]*Fb[:, 1, 1]-Fb[:, 0, 1]*Fb[:, 1, 0]
+            F[back] = np.stack([np.stack([Fb[:, 1, 1], -Fb[:, 0, 1]], -1),
+                                np.stack([-Fb[:, 1, 0], Fb[:, 0, 0]], -1)], -2)/det[:, None, None]
+
+        q0 = np.asarray(self.seedq.q).astype(np.result_type(dtype, np.complex64))
+        return (F[:, 0, 0]*q0+F[:, 0, 1])/(F[:, 1, 0]*q0+F[:, 1, 1])
+
+
+
+    def paretoSearch(self, componentLabels, lowerBounds, upperBounds, moveTarget = False,
+                     population = 10000, generations = 20, tolerance = 1e-3, archiveSize = 1000,
+                     seed = None):
+
+        #  -- beamPath.paretoSearch --
+        #
+        #     Multi-objective search over the positions of the listed 
+        #     components (and of the target, if moveTarget is True, in which
+        #     case the bounds have one extra entry for targetz). Each design is
+        #     scored on three objectives:
+        #         overlap - the target overlap (maximized).
+        #         sensitivity - the mean change of overlap when one of the
+        #                       listed components is misplaced by +/- tolerance
+        #                       (minimized).
+        #         length - the total length of the layout, from the first to
+        #                  the last of the seed, target and components 
+        #                  (minimized).
+        #     Returns the Pareto front, the designs which no other design beats
+        #     on all three, as a record array with fields z (the positions, 
+        #     one column per label, then targetz), overlap, sensitivity and 
+        #     length, sorted by decreasing overlap.
+        #     Each generation mutates designs drawn from the current front and
+        #     evaluates the whole population in one propagateEnsemble call. At most
+        #     archiveSize front designs are kept between generations, spread
+        #     evenly over the range of overlap values, which also bounds the
+        #     size of the result.
+        #     Example:
+        #     front = path1.paretoSearch(['lens1','lens2'], [0, 0.5], [0.5, 1.5])
+        #     best = front[0]
+        #     robust = front[np.argmin(front.sensitivity)]
+
+        rng = np.random.default_rng(seed)
+
+        lb = np.asarray(lowerBounds, dtype = float)
+        ub = np.asarray(upperBounds, dtype = float)
+        nlabels = len(componentLabels)
+        if len(lb) != nlabels+bool(moveTarget) or len(ub) != len(lb):
+            raise Exception ("Bounds must have one entry per label (plus one for the target if it moves).")
+
+        comps = self.components
+        fixed = [_zvalue(c) for c in comps if getattr(c, 'label', None) not in componentLabels]
+        fixed = fixed + [self.seedz] + ([] if moveTarget else [self.targetz])
+        zfixed = (min(fixed), max(fixed))
+
+        def evaluate(X):
+            n = len(X)
+            zout = X[:, nlabels] if moveTarget else self.targetz
+            pos = X[:, :nlabels]
+
+            # nominal designs, then each label moved by +/- tolerance
+            shifts = np.concatenate([np.zeros((1, nlabels)),
+                                     tolerance*np.eye(nlabels), -tolerance*np.eye(nlabels)])
+            allpos = (pos[None, :, :] + shifts[:, None, :]).reshape(len(shifts)*n, nlabels)
+            allz = np.broadcast_to(zout, (len(shifts), n)).reshape(-1)
+
+            q = self.propagateEnsemble(allpos, allz, componentLabels)
+            eta = self.targetq.overlap(q, self.targetq).reshape(len(shifts), n)
+
+            overlap = eta[0]
+            sensitivity = np.abs(eta[1:]-overlap).sum(axis = 0)/max(2*nlabels, 1)
+            length = np.maximum(X.max(axis = 1), zfixed[1]) - np.minimum(X.min(axis = 1), zfixed[0])
+
+            return overlap, sensitivity, length
+
+        def select(X, objectives):
+            # the front of the merged designs, thinned to archiveSize
+            F = np.stack([-objectives[0], objectives[1], objectives[2]], 1)
+            keep = np.flatnonzero(_nondominated(F))
+            if len(keep) > archiveSize:
+                # archiveSize bins over the overlap range, filled round-robin
+                # from the best overlap in each bin down
+                keep = keep[np.argsort(F[keep, 0], kind = 'stable')]
+                vals = F[keep, 0]
+                span = (vals[-1]-vals[0]) or 1.
+                bins = np.minimum(((vals-vals[0])/span*archiveSize).astype(int), archiveSize-1)
+                rank = np.arange(len(keep)) - np.searchsorted(bins, bins)
+                keep = keep[np.lexsort((bins, rank))[:archiveSize]]
+            return X[keep], [o[keep] for o in objectives]
+
+        X = lb + (ub-lb)*rng.random((population, len(lb)))
+        X, objectives = select(X, evaluate(X))
+
+        for gen in range(generations):
+            # mutation scale shrinks from 10% to 1% of the search range
+            sigma = (ub-lb)*0.1*0.1**(gen/max(generations-1, 1))
+
+            parents = rng.integers(len(X), size = population)
+            mates = rng.integers(len(X), size = population)
+            mix = rng.random((population, 1))
+            Xnew = mix*X[parents] + (1-mix)*X[mates] + sigma*rng.standard_normal((population, len(lb)))
+            Xnew = np.clip(Xnew, lb, ub)
+            new = evaluate(Xnew)
+
+            X, objectives = select(np.concatenate([X, Xnew]),
+                                   [np.concatenate([o, n]) for o, n in zip(objectives, new)])
+
+        overlap, sensitivity, length = objectives
+        best = np.argsort(-overlap)
+        result = np.zeros(len(best), dtype = [('z', float, (len(lb),)), ('overlap', float),
+                                              ('sensitivity', float), ('length', float)])
+        result['z'] = X[best]
+        result['overlap'] = overlap[best]
+        result['sensitivity'] = sensitivity[best]
+        result['length'] = length[best]
+
+        return result.view(np.recarray)
+
+
+
+    def waists(self, zmin = -np.inf, zmax = np.inf):
+
+        #  -- beamPath.waists --
+        #
+        #     Finds every beam waist in the path, analytically: the waist of
+        #     the beam leaving each component is at z - waistZ of the q value
+        #     there, and it is kept if it falls before the next component.
+        #     Returns a record array with fields
+        #         z - position of the waist.
+        #         waistSize - the waist size.
+        #         segment - index of the component just upstream of the waist
+        #                   (as returned by findSegment, -1 before the first).
+        #         label - label of that component ('' before the first).
+        #     zmin and zmax optionally limit the positions returned; the first
+        #     and last segments are otherwise unbounded.
+        #     Example:
+        #     w = path1.waists(0, 2)
+        #     print (w.z, w.waistSize, w.label)
+
+        zb, qb, zhead, qhead = self.boundaryQ()
+        comps = self.components
+        ncomps = len(zb)
+
+        zref = np.concatenate([[zhead], zb])
+        qref = np.concatenate([[qhead], qb])
+        lo = np.concatenate([[-np.inf], zb])
+        hi = np.concatenate([zb, [np.inf]])
+
+        beams = beamq(qref, self.seedq.wavelength, self.seedq.M2)
+        zw = zref - beams.waistZ
+
+        keep = (zw >= lo) & (zw < hi) & (zw >= zmin) & (zw <= zmax)
+        keep = np.flatnonzero(keep)
+
+        labels = [''] + [str(getattr(c, 'label', '')) for c in comps]
+
+        return np.rec.fromarrays([zw[keep], beams.waistSize[keep], keep-1,
+                                  np.array([labels[k] for k in keep], dtype = str).reshape(-1)],
+                                 names = 'z,waistSize,segment,label')
+
+
+
+    @property
+    def targetOverlap(self):
+
+        #  -- beamPath.targetOverlap --
+        #
+        #     The overlap fraction between the seed beam propagated to targetz
+        #     and the target beam.
+
+        qt = self.qPropagate(self.targetz)
+
+        return self.targetq.overlap(qt, self.targetq)
+
+
+
+    def optimizePath(self, componentLabels, lowerBounds = None, upperBounds = None):
+
+        #  -- beamPath.optimizePath --
+        #
+        #     Moves the listed components to maximize the overlap with the
+        #     target beam, using a Nelder-Mead search over their z positions.
+        #     lowerBounds and upperBounds are optional lists of position limits
+        #     (one per label, None for no limit). The calling path is not
+        #     changed; the optimized path is returned.
+        #     Example:
+        #     path2 = path1.optimizePath(['lens1','lens2'], [0, 0.5], [0.5, 1.5])
+        #     print (path2.targetOverlap)
+
+        from scipy.optimize import minimize
+
+        pathdup = self.duplicate()
+        comps = [pathdup.component(label) for label in componentLabels]
+
+        if lowerBounds is None:
+            lowerBounds = [None]*len(comps)
+        if upperBounds is None:
+            upperBounds = [None]*len(comps)
+        bounds = list(zip(lowerBounds, upperBounds))
+
+        z0 = np.clip([_zvalue(c) for c in comps],
+                     [-np.inf if b[0] is None else b[0] for b in bounds],
+                     [np.inf if b[1] is None else b[1] for b in bounds])
+
+        def lossFunc(zVec):
+            for label, z in zip(componentLabels, zVec):
+                pathdup.moveComponent(label, float(z), 'absolute')
+            return 1-pathdup.targetOverlap
+
+        result = minimize(lossFunc, z0, method = 'Nelder-Mead', bounds = bounds)
+        lossFunc(result.x)
+
+        return pathdup
+
+
+
+    @staticmethod
+    def profile():
+
+        #  -- beamPath.profile --
+        #
+        #     Context manager which times the stages of beam propagation 
+        #     (sorting, index lookup, matrix products, beamq construction and
+        #     duplicate calls). The instrumentation is only installed inside the
+        #     with block, so it costs nothing otherwise. See profiling.py.
+        #     Example:
+        #     with beamPath.profile() as stats:
+        #         path1.qPropagate(zlist)
+        #     stats.display()
 
-a = beamPath(0,0,0,0)
-b = a.duplicate()
-print (a, b)
-print ('  next  ')
-print (a.seedq, a.seedz, a.targetq, a.components_raw)
+        import profiling
+        return profiling.profile()
 
 
 
+##Example:
+#seed = beamq.beamWaistAandZ(100e-6, 0)
+#target = beamq.beamWaistAandZ(50e-6, 1.2)
+#path1 = beamPath(seed, 0, target, 1.2)
+#path1.addComponent(component.lens([0.5],[0.4],['lens1']))
+#path1.addComponent(component.lens([0.3],[0.9],['lens2']))
+#print (path1.qPropagate(1.2).waistSize, path1.targetOverlap)
@@ -0,0 +1,30 @@
+import numpy as np
+import matplotlib.pyplot as plt
+
+
+# Plotting helpers. These live in their own module so that importing beamq,
+# component or beamPath does not load matplotlib.
+
+
+def plotBeamWidth (qarray, zdomain, *args):
+
+    # -- beamPlot.plotBeamWidth --
+    #
+    #    Plots the beam width (and its negative) against zdomain. qarray is 
+    #    either a list of beamq objects, one per point in zdomain, or a single
+    #    beamq holding an array of q values such as returned by 
+    #    beamPath.qPropagate(zdomain).
+    #    Example:
+    #    beamPlot.plotBeamWidth(path1.qPropagate(zdomain), zdomain)
+
+    if isinstance(qarray, (list, tuple)):
+        width = np.array([q.beamWidth for q in qarray])
+    else:
+        width = qarray.beamWidth
+
+    ploth = plt.plot(zdomain, width, *args)
+    plt.plot(zdomain, -width, *args)
+
+    plt.show()
+
+    return ploth
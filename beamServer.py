@@ -0,0 +1,434 @@
+import asyncio
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from beamq import beamq
+from component import component
+from beamPath import beamPath
+
+
+# Line based JSON protocol. Each request is one line:
+#     {"id": 1, "op": "propagate", "name": "arm1", "z": [0.1, 0.2]}
+# and each reply is one line carrying the same id:
+#     {"id": 1, "ok": true, "result": {...}}  or  {"id": 1, "ok": false, "error": "..."}
+# Replies may arrive out of order. Complex q values are sent as [re, im].
+#
+# ops:
+#     create    - name, seed, seedz, target, targetz, components
+#                 (seed/target are {"q": [re, im]} or {"w0": w0, "z": z},
+#                 both with optional "wavelength" and "M2"; components are dicts with
+#                 a "type" of lens, curvedMirror, flatMirror, propagator,
+#                 dielectric or matrix plus the constructor arguments)
+#     delete    - name
+#     list      - names of the paths held by the server
+#     propagate - name, z (number or list); returns q and beamWidth
+#     overlap   - name, optional z (default targetz) and q (list of [re, im],
+#                 with optional M2, default the target beam); returns the 
+#                 overlap fractions
+#     move      - name, label, displacement, optional absolute
+#     optimize  - name, labels, optional lowerBounds, upperBounds, apply
+#                 (apply is refused if the path was edited or deleted while
+#                 the optimization ran)
+
+
+def _toq(values):
+
+    return np.asarray(values, dtype = float).view(complex)[..., 0]
+
+
+def _fromq(q):
+
+    q = np.asarray(q, dtype = complex)
+    return np.stack([q.real, q.imag], axis = -1).tolist()
+
+
+def _makeBeam(spec):
+
+    wavelength = spec.get('wavelength', 1064e-9)
+    M2 = spec.get('M2', 1)
+
+    if 'q' in spec:
+        return beamq(complex(*spec['q']), wavelength, M2)
+
+    return beamq.beamWaistAandZ(spec['w0'], spec.get('z', 0), wavelength, M2)
+
+
+def _makeComponent(spec):
+
+    kind = spec['type']
+    z = spec.get('z', 0)
+    label = spec.get('label')
+
+    if kind == 'lens':
+        labels = None if label is None else [label]
+        c = component.lens([spec['focalLength']], [z], labels)
+    elif kind == 'curvedMirror':
+        labels = None if label is None else [label]
+        c = component.curvedMirror([spec['ROC']], [z], labels)
+    elif kind == 'flatMirror':
+        c = component.flatMirror(z, label)
+    elif kind == 'propagator':
+        c = component.propagator(spec['length'], z, label)
+    elif kind == 'dielectric':
+        c = component.dielectric(spec['R1'], spec['R2'], spec.get('thickness', 0),
+                                 spec.get('n', 1), z, label)
+    elif kind == 'matrix':
+        c = component(np.matrix(spec['M']), z, label)
+    else:
+        raise Exception ("Unknown component type '%s'." % kind)
+
+    return c
+
+
+def _optimize(path, labels, lowerBounds, upperBounds):
+
+    # runs in the executor, so it must be a module level function
+    return path.optimizePath(labels, lowerBounds, upperBounds)
+
+
+
+class beamServer(object):
+
+    """
+    -- beamServer --
+
+        An asyncio server which keeps named beamPath objects in memory and
+        answers propagation, overlap and layout requests over a socket.
+
+        Propagation requests for the same path which arrive within
+        batchWindow seconds of each other are answered with a single
+        vectorized qPropagate call. Optimizations run in a process pool so
+        the event loop keeps serving other requests meanwhile.
+
+        Example:
+            server = beamServer()
+            await server.start('127.0.0.1', 8765)
+            ...
+            await server.close()
+        or from the command line:
+            python beamServer.py --port 8765
+    """
+
+    def __init__(self, batchWindow = 0.0, executor = None):
+
+        self.paths = {}
+        self.batchWindow = batchWindow
+        self.executor = executor
+        self.server = None
+        self.batchCount = 0
+
+        self._pending = {}
+
+
+    async def start(self, host = '127.0.0.1', port = 0):
+
+        self.server = await asyncio.start_server(self._client, host, port)
+        return self.server.sockets[0].getsockname()[:2]
+
+
+    async def serve_forever(self):
+
+        await self.server.serve_forever()
+
+
+    async def close(self):
+
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.executor is not None:
+            self.executor.shutdown(wait = False)
+
+
+    async def _client(self, reader, writer):
+
+        tasks = set()
+        lock = asyncio.Lock()
+
+        async def reply(line):
+            try:
+                message = json.loads(line)
+                if not isinstance(message, dict):
+                    raise ValueError ("expected a JSON object")
+            except ValueError as e:
+                message = {}
+                response = {'ok': False, 'error': 'bad request: %s' % e}
+            else:
+                response = await self.handle(message)
+            response['id'] = message.get('id')
+
+            # one reply at a time, waiting for the transport to drain so a
+            # slow client pushes back on the server
+            async with lock:
+                writer.write((json.dumps(response)+'\n').encode())
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    pass
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.ensure_future(reply(line))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            writer.close()
+
+
+    async def handle(self, message):
+
+        # -- beamServer.handle --
+        #
+        #    Dispatches one decoded request and returns the reply dictionary.
+        #    Can be awaited directly, without a socket.
+
+        try:
+            op = getattr(self, 'op_'+str(message.get('op')), None)
+            if op is None:
+                raise Exception ("Unknown op '%s'." % message.get('op'))
+            result = await op(message)
+        except Exception as e:
+            return {'ok': False, 'error': str(e)}
+
+        return {'ok': True, 'result': result}
+
+
+    def _path(self, name):
+
+        if name not in self.paths:
+            raise Exception ("No beam path named '%s'." % name)
+
+        return self.paths[name]
+
+
+    # batching of propagation requests
+
+    def _flush(self, name):
+
+        pending = self._pending.pop(name, None)
+        if not pending:
+            return
+
+        try:
+            path = self._path(name)
+            zall = np.concatenate([z.ravel() for z, future in pending])
+            qall = path.qPropagate(zall)
+            self.batchCount += 1
+        except Exception as e:
+            for z, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        start = 0
+        for z, future in pending:
+            stop = start + z.size
+            qout = beamq(qall.q[start:stop].reshape(z.shape), qall.wavelength, qall.M2)
+            start = stop
+            if not future.done():
+                future.set_result(qout)
+
+
+    def _propagate(self, name, z):
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        if name not in self._pending:
+            self._pending[name] = []
+            loop.call_later(self.batchWindow, self._flush, name)
+        self._pending[name].append((np.asarray(z, dtype = float), future))
+
+        return future
+
+
+    # ops
+
+    async def op_create(self, message):
+
+        self._flush(message['name'])
+
+        comps = [_makeComponent(spec) for spec in message.get('components', [])]
+        target = message.get('target')
+        path = beamPath(_makeBeam(message['seed']), message.get('seedz', 0),
+                        None if target is None else _makeBeam(target),
+                        message.get('targetz', 0), comps)
+
+        self.paths[message['name']] = path
+        return {'name': message['name'], 'components': len(comps)}
+
+
+    async def op_delete(self, message):
+
+        self._flush(message['name'])
+        self._path(message['name'])
+        del self.paths[message['name']]
+        return {'name': message['name']}
+
+
+    async def op_list(self, message):
+
+        return sorted(self.paths)
+
+
+    async def op_propagate(self, message):
+
+        self._path(message['name'])
+        qout = await self._propagate(message['name'], message['z'])
+
+        return {'q': _fromq(qout.q), 'beamWidth': np.asarray(qout.beamWidth).tolist()}
+
+
+    async def op_overlap(self, message):
+
+        path = self._path(message['name'])
+        z = message.get('z', path.targetz)
+
+        if 'q' in message:
+            qt = beamq(_toq(message['q']), path.seedq.wavelength, message.get('M2', 1))
+        elif path.targetq is not None:
+            qt = path.targetq
+        else:
+            raise Exception ("Path '%s' has no target beam." % message['name'])
+
+        qout = await self._propagate(message['name'], z)
+
+        return {'overlap': beamq.overlapMatrix(qout, qt).tolist()}
+
+
+    async def op_move(self, message):
+
+        self._flush(message['name'])
+        path = self._path(message['name'])
+        isabsolute = 'absolute' if message.get('absolute') else ''
+        path.moveComponent(message['label'], message['displacement'], isabsolute)
+
+        return {'label': message['label'], 'z': path.component(message['label']).z}
+
+
+    async def op_optimize(self, message):
+
+        name = message['name']
+        path = self._path(name)
+
+        if self.executor is None:
+            # spawn rather than fork, so workers do not inherit the event loop
+            # and the open client sockets
+            self.executor = ProcessPoolExecutor(mp_context = multiprocessing.get_context('spawn'))
+
+        # the optimizer works on a copy, so note the state it started from
+        version = path.stateVersion
+
+        loop = asyncio.get_event_loop()
+        newpath = await loop.run_in_executor(self.executor, _optimize, path.duplicate(),
+                                             message['labels'], message.get('lowerBounds'),
+                                             message.get('upperBounds'))
+
+        if message.get('apply'):
+            if self.paths.get(name) is not path or path.stateVersion != version:
+                raise Exception ("Path '%s' was changed or deleted during the optimization;"
+                                 " the result was not applied." % name)
+            self._flush(name)
+            self.paths[name] = newpath
+
+        return {'z': [newpath.component(label).z for label in message['labels']],
+                'overlap': newpath.targetOverlap}
+
+
+
+class beamClient(object):
+
+    """
+    -- beamClient --
+
+        Minimal client for beamServer. Requests may be issued concurrently
+        over one connection; replies are matched to requests by id.
+
+        Example:
+            client = await beamClient.connect('127.0.0.1', 8765)
+            result = await client.call('propagate', name = 'arm1', z = [0.1, 0.2])
+            await client.close()
+    """
+
+    def __init__(self, reader, writer):
+
+        self.reader = reader
+        self.writer = writer
+        self.nextId = 0
+        self.waiting = {}
+        self.listener = asyncio.ensure_future(self._listen())
+
+
+    @staticmethod
+    async def connect(host = '127.0.0.1', port = 8765):
+
+        reader, writer = await asyncio.open_connection(host, port)
+        return beamClient(reader, writer)
+
+
+    async def _listen(self):
+
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            response = json.loads(line)
+            future = self.waiting.pop(response.get('id'), None)
+            if future is not None and not future.done():
+                future.set_result(response)
+
+        for future in self.waiting.values():
+            if not future.done():
+                future.set_exception(ConnectionError ("connection closed"))
+
+
+    async def call(self, op, **kwargs):
+
+        self.nextId += 1
+        message = dict(kwargs, op = op, id = self.nextId)
+        future = asyncio.get_event_loop().create_future()
+        self.waiting[self.nextId] = future
+
+        self.writer.write((json.dumps(message)+'\n').encode())
+        response = await future
+
+        if not response['ok']:
+            raise Exception (response['error'])
+        return response['result']
+
+
+    async def close(self):
+
+        self.writer.close()
+        await self.listener
+
+
+
+async def main(host, port):
+
+    server = beamServer()
+    address = await server.start(host, port)
+    print ('beamServer listening on %s:%d' % address)
+    try:
+        await server.serve_forever()
+    finally:
+        await server.close()
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'beamPath request server')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8765)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.host, args.port))
@@ -1,5 +1,4 @@
 import numpy as np
-import matplotlib.pyplot as plt
 
 class beamq:
     
@@ -12,9 +11,15 @@ class beamq:
         properties of a beamq object, it can return various properties
         of the beam.
 
+        Beams which are not pure TEM00 can be described with an M2 (beam
+        quality factor M^2) other than 1, using the embedded gaussian model:
+        q is the q parameter of the embedded TEM00 beam, which propagates
+        through ABCD matrices as usual, and the real beam is larger by a 
+        factor M = sqrt(M2) in width, waist size and divergence. 
+
         Constructor Methods:
-            Note: The default value of wavelength is 1064nm.
-            beamq(q,wavelength) - returns a beamq object with the defined q
+            Note: The default value of wavelength is 1064nm, and of M2 is 1.
+            beamq(q,wavelength,M2) - returns a beamq object with the defined q
                 value for wavelength (in meters).
             beamq.beamWaistAndZ(w0,Z,wavelength) - returns a beamq object
                 with a waist of w0 (in meters) at position Z (in meters)
@@ -25,6 +30,8 @@ class beamq:
             beamq.beamWidthAndR(w,R,wavelength) - returns a beamq object
                 with a beam width of w (in meters) at Z=0 and a radius of 
                 R (in meters) Z=0 with wavelength (in meters).
+            All of these take an optional M2 argument, and w0 and w are
+            then the sizes of the real (M2 times diffraction limited) beam.
 
         Properties:
             beamWidth - the 1/e electric field amplitude radius.
@@ -39,39 +46,40 @@ class beamq:
                     this is also the imaginary part of the q parameter.
     """
     
-    def __init__(self, q, wavelength = 1064e-9):
+    def __init__(self, q, wavelength = 1064e-9, M2 = 1):
         
         self.q = q
         self.wavelength = wavelength
+        self.M2 = M2
         
     
 
     @staticmethod
-    def beamWaistAandZ(w0, Z, wavelength = 1064e-9):
+    def beamWaistAandZ(w0, Z, wavelength = 1064e-9, M2 = 1):
         
-        ZR = np.pi*w0**2/wavelength
+        ZR = np.pi*w0**2/(M2*wavelength)
         q = Z+1j*ZR
         
-        return beamq(q, wavelength)
+        return beamq(q, wavelength, M2)
         
     
     @staticmethod
-    def beamWaistAandR(w0, R, wavelength = 1064e-9):
+    def beamWaistAandR(w0, R, wavelength = 1064e-9, M2 = 1):
         
-        ZR = np.pi*w0**2/wavelength
+        ZR = np.pi*w0**2/(M2*wavelength)
         q = (1/R-1j/ZR)**(-1)
         
-        return beamq(q, wavelength)
+        return beamq(q, wavelength, M2)
     
 
     @staticmethod
-    def beamWidthAandR(w, R, wavelength = 1064e-9):
+    def beamWidthAandR(w, R, wavelength = 1064e-9, M2 = 1):
         
-        Z = R/(1+(R*wavelength/np.pi/w**2)**2)
+        Z = R/(1+(R*M2*wavelength/np.pi/w**2)**2)
         ZR = np.sqrt(Z*(R-Z))
         q = Z+1j*ZR
         
-        return beamq(q, wavelength)
+        return beamq(q, wavelength, M2)
         
     
     @staticmethod
@@ -85,7 +93,7 @@ class beamq:
 
     def set_q(self, qvalue):
         
-        if qvalue.imag < 0:
+        if np.any(np.imag(qvalue) < 0):
             raise Exception ("imaginary part of q parameter must be positive")
         
         self.q = qvalue
@@ -100,6 +108,16 @@ class beamq:
 
         self.wavelength = newwavelength
         return self
+
+
+
+    def set_M2(self, newM2):
+
+        if np.any(np.asarray(newM2) < 1):
+            raise Exception ("M2 must be at least 1")
+
+        self.M2 = newM2
+        return self
     
 
 
@@ -111,7 +129,7 @@ class beamq:
         #    Example:
         #    beamcopy = beam1.duplicate();
 
-        return beamq(self.q, self.wavelength)
+        return beamq(self.q, self.wavelength, self.M2)
 
 
 
@@ -119,7 +137,7 @@ class beamq:
     @property
     def waistSize(self):
 
-        return np.sqrt((self.q.imag)*self.wavelength/np.pi)
+        return np.sqrt((self.q.imag)*self.M2*self.wavelength/np.pi)
 
 
     @property
@@ -127,7 +145,7 @@ class beamq:
 
         w0 = self.waistSize
 
-        return np.pi*w0**2/self.wavelength
+        return np.pi*w0**2/(self.M2*self.wavelength)
 
 
     @property
@@ -161,6 +179,10 @@ class beamq:
         z = self.waistZ
         zR = self.rayleighRange
 
+        if np.ndim(z) > 0:
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                return np.where(z != 0, z*(1+(zR/z)**2), np.inf)
+
         if z != 0:
             return z*(1+(zR/z)**2)
 
@@ -176,24 +198,98 @@ class beamq:
         # -- beamq.overlap --
         #
         #    Find the overlap fraction of 2 beams (assumes axial symmetry).
+        #    For beams with M2 > 1 this is an estimate: the overlap of the
+        #    embedded gaussians, times M2min/M2max for each transverse axis.
+        #    This is 1/M2 per axis for a beam coupled into a TEM00 mode, and
+        #    leaves the overlap of a beam with itself at 1.
         
 
         q1 = beam1.q
         q2 = beam2.q
 
-        w1 = beam1.waistSize
-        w2 = beam2.waistSize
-        self.wavelength = beam1.wavelength
+        w1 = beam1.waistSize/np.sqrt(beam1.M2)
+        w2 = beam2.waistSize/np.sqrt(beam2.M2)
+        wavelength = beam1.wavelength
 
-        if self.wavelength != beam2.wavelength:
+        if wavelength != beam2.wavelength:
             raise Exception ("Cannot overlap beams of different wavelength.")
 
-        fraction = (2*np.pi/self.wavelength*w1*w2*1/abs(q2.conjugate()-q1))**2
+        fraction = (2*np.pi/wavelength*w1*w2*1/abs(q2.conjugate()-q1))**2
         # square for 2D modematching
+        fraction = fraction*(np.minimum(beam1.M2, beam2.M2)/np.maximum(beam1.M2, beam2.M2))**2
+
         return fraction
 
 
 
+    @staticmethod
+    def overlapMatrix(q1, q2, maxBytes = None, out = None, M2a = 1, M2b = 1):
+
+        # -- beamq.overlapMatrix --
+        #
+        #    Overlap fraction between every beam in q1 and every beam in q2.
+        #    q1 and q2 are arrays of q values (or beamq objects holding arrays
+        #    of q), of the same wavelength. The result has shape
+        #    q1.shape + q2.shape, and element [i,j] equals
+        #    beamq.overlap(beam1[i], beam2[j]).
+        #    Since w**2 = Im(q)*wavelength/pi, the overlap reduces to
+        #    4*Im(q1)*Im(q2)/|conj(q2)-q1|**2, independent of wavelength.
+        #    M2a and M2b (scalars or arrays shaped like q1 and q2) give the 
+        #    beam quality of each set, and are taken from q1 and q2 when these
+        #    are beamq objects. The same M2 correction as beamq.overlap is applied.
+        #    maxBytes caps the memory used for temporaries by computing the 
+        #    result a block of q1 rows at a time. out may be a preallocated 
+        #    float array (e.g. a numpy memmap) to write the result into.
+        #    Example:
+        #    eta = beamq.overlapMatrix(seedqs, cavityqs, maxBytes = 2**28)
+
+        if isinstance(q1, beamq) and isinstance(q2, beamq) \
+        and q1.wavelength != q2.wavelength:
+            raise Exception ("Cannot overlap beams of different wavelength.")
+
+        M2a = getattr(q1, 'M2', M2a)
+        M2b = getattr(q2, 'M2', M2b)
+        q1 = np.asarray(getattr(q1, 'q', q1), dtype = complex)
+        q2 = np.asarray(getattr(q2, 'q', q2), dtype = complex)
+        shape = q1.shape + q2.shape
+
+        if out is None:
+            out = np.empty(shape)
+        elif out.shape != shape:
+            raise Exception ("out must have shape %s." % (shape,))
+
+        rows = q1.reshape(-1, 1)
+        cols = q2.reshape(1, -1)
+        flat = out.reshape(rows.shape[0], cols.shape[1])
+
+        ideal = np.all(np.asarray(M2a) == 1) and np.all(np.asarray(M2b) == 1)
+        if not ideal:
+            m2rows = np.broadcast_to(np.asarray(M2a, dtype = float), q1.shape).reshape(-1, 1)
+            m2cols = np.broadcast_to(np.asarray(M2b, dtype = float), q2.shape).reshape(1, -1)
+
+        # about 4 complex/float temporaries of 8 or 16 bytes per element, and
+        # 2 more float ones (the M2 ratio and its denominator) unless ideal
+        if maxBytes is None:
+            chunk = max(rows.shape[0], 1)
+        else:
+            perElement = 48 if ideal else 64
+            chunk = max(int(maxBytes // (perElement*max(cols.shape[1], 1))), 1)
+
+        for j in range(0, rows.shape[0], chunk):
+            d = cols.conjugate() - rows[j:j+chunk]
+            np.multiply(4*rows[j:j+chunk].imag, cols.imag, out = flat[j:j+chunk])
+            flat[j:j+chunk] /= d.real**2 + d.imag**2
+            del d
+            if not ideal:
+                ratio = np.minimum(m2rows[j:j+chunk], m2cols)
+                ratio /= np.maximum(m2rows[j:j+chunk], m2cols)
+                ratio *= ratio
+                flat[j:j+chunk] *= ratio
+
+        return out
+
+
+
     def transform (self, M = np.matrix ('1,0;0,1')):
 
         # -- beamq.transform --
@@ -220,8 +316,7 @@ class beamq:
         # -- beamq.plotBeamWidth --
         #
         #    Given an array of beamq objects, this function will plot the beamwidth.
-        
-        ploth = plt.plot(zdomain, [q.get_beamWidth(q) for q in qarray], *args)
-        plt.plot(zdomain, [-q.get_beamWidth(q) for q in qarray], *args)
+        #    matplotlib is only imported when this is called, see beamPlot.py.
 
-        plt.show()
+        import beamPlot
+        return beamPlot.plotBeamWidth(qarray, zdomain, *args)
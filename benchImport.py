@@ -0,0 +1,41 @@
+import subprocess
+import sys
+
+
+# Import time benchmark for the headless core (beamq, component, beamPath).
+# Each import is timed in a fresh interpreter. numpy is imported before the
+# clock starts, since every user of alm pays for it anyway; the budget 
+# applies to what alm adds on top. Run with:  python benchImport.py
+
+budget = 0.050
+repeats = 5
+
+code = """
+import sys, time
+import numpy
+t0 = time.perf_counter()
+import beamPath
+dt = time.perf_counter()-t0
+print (dt, 'matplotlib' in sys.modules)
+"""
+
+
+def timeImport():
+
+    out = subprocess.check_output([sys.executable, '-c', code], universal_newlines = True)
+    dt, plotted = out.split()
+
+    return float(dt), plotted == 'True'
+
+
+if __name__ == '__main__':
+
+    results = [timeImport() for j in range(repeats)]
+    best = min(dt for dt, plotted in results)
+
+    print ('import beamPath: best of %d = %.1f ms (budget %.0f ms)' % (repeats, 1e3*best, 1e3*budget))
+
+    if any(plotted for dt, plotted in results):
+        sys.exit('matplotlib was imported by the core modules')
+    if best > budget:
+        sys.exit('import time over budget')
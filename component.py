@@ -336,6 +336,37 @@ class componentList(list):
 #print (CC, CC.M, CC.type)
 
 
+    @staticmethod
+    def combineBatch(Ms, dtype = np.float64):
+
+        # -- component.combineBatch --
+        # Batched version of combine. Ms is an array of shape
+        # (..., ncomponents, 2, 2) holding the transfer matrices of a list of
+        # components for many samples at once; returns the (..., 2, 2) array
+        # of products, multiplied in order of index array as in combine.
+        # The products are accumulated in dtype (e.g. np.float32 to halve
+        # the memory of large ensembles).
+
+        Ms = np.asarray(Ms, dtype = dtype)
+
+        A = np.ones(Ms.shape[:-3], dtype = dtype)
+        B = np.zeros(Ms.shape[:-3], dtype = dtype)
+        C = np.zeros(Ms.shape[:-3], dtype = dtype)
+        D = np.ones(Ms.shape[:-3], dtype = dtype)
+
+        for j in range(Ms.shape[-3]):
+            m = Ms[..., j, :, :]
+            A, B, C, D = (m[..., 0, 0]*A + m[..., 0, 1]*C, m[..., 0, 0]*B + m[..., 0, 1]*D,
+                          m[..., 1, 0]*A + m[..., 1, 1]*C, m[..., 1, 0]*B + m[..., 1, 1]*D)
+
+        return np.stack([np.stack([A, B], -1), np.stack([C, D], -1)], -2)
+
+#Example:
+#C = componentList([A,D,E,F])
+#Ms = np.array([[c.M for c in C]]*1000)
+#print (componentList.combineBatch(Ms)[0], C.combine().M)
+
+
     def display(self):
         
         print (' label  '+'  z(m)  '+'  type  '+'  parameters')
@@ -362,7 +393,7 @@ class componentList(list):
         
         comps = np.transpose([labelList, zList, typeList, parameterList])
         for i in range(len(comps)):
-            print comps[i] #.tostring()
+            print (comps[i]) #.tostring()
 
 ##Example:
 #A = component.lens([3],[0.2],['lb1'])
@@ -0,0 +1,80 @@
+from beamPath import beamPath
+
+
+class pathNetwork(object):
+
+    """
+    -- pathNetwork --
+
+        A tree of beam paths, e.g. one laser split by beamsplitters into
+        several arms. The trunk is an ordinary beamPath holding the seed
+        beam. Every other path in the network is linked to a parent path
+        (see beamPath.set_parent): its seed beam is the parent's beam at the
+        branch position, read from the parent's propagation cache.
+
+        Propagation of a shared segment is therefore done once, however
+        many arms hang off it. Editing an arm only invalidates that arm (and
+        the arms branching from it); editing the trunk makes the arms pick
+        up a new seed beam, but their own cached ABCD products are kept.
+
+        Methods:
+            pathNetwork(trunk) - creates a network from a trunk beamPath.
+            addArm(name, zlink, ...) - adds a path branching from the trunk
+                    (or another arm) at position zlink.
+            path(name) - returns the named beamPath ('trunk' for the trunk).
+            qPropagate(name, z) - the beam at z in the named path.
+            targetOverlaps() - the target overlap of every path with a target.
+
+        Example:
+            net = pathNetwork(trunk)
+            net.addArm('arm1', 0.6, components = [component.lens([0.2],[0.9],['a1'])])
+            net.addArm('arm2', 0.8, targetq = target2, targetz = 1.7)
+            w = net.qPropagate('arm1', 1.2).beamWidth
+    """
+
+    def __init__(self, trunk):
+
+        self.paths = {'trunk': trunk}
+
+
+    def addArm(self, name, zlink, parent = 'trunk', components = None, targetq = None, targetz = 0):
+
+        # -- pathNetwork.addArm --
+        #
+        #    Adds a path called name whose seed beam is the beam of the parent
+        #    path at zlink. Positions in the arm continue the z coordinate of
+        #    the parent, so components in the arm should be downstream of zlink.
+        #    Returns the new beamPath.
+
+        if name in self.paths:
+            raise Exception ("The network already has a path named '%s'." % name)
+
+        arm = beamPath(None, zlink, targetq, targetz, components)
+        arm.set_parent(self.path(parent), zlink)
+
+        self.paths[name] = arm
+        return arm
+
+
+    def path(self, name):
+
+        if name not in self.paths:
+            raise Exception ("No path named '%s' in this network." % name)
+
+        return self.paths[name]
+
+
+    def qPropagate(self, name, z):
+
+        return self.path(name).qPropagate(z)
+
+
+    def targetOverlaps(self):
+
+        # -- pathNetwork.targetOverlaps --
+        #
+        #    Returns a dictionary of the target overlap of every path in the
+        #    network which has a target beam.
+
+        return dict((name, p.targetOverlap) for name, p in self.paths.items()
+                    if p.targetq is not None)
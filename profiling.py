@@ -0,0 +1,139 @@
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import beamq as _beamq
+import component as _component
+import beamPath as _beamPath
+
+
+# (class or module, function name, stage) for every function timed by profile().
+# Times are inclusive, so a 'propagate' call also contains the time of the
+# sorting, index lookup, matrix and beamq stages it triggers.
+_hooks = [
+    (_beamPath.beamPath, 'qPropagate', 'propagate'),
+    (_beamPath.beamPath, 'sortComponents', 'sort'),
+    (_beamPath.beamPath, 'findComponentIndex', 'index'),
+    (_beamPath.beamPath, 'findSegment', 'index'),
+    (_beamPath.beamPath, 'inverseMatrix', 'matrix'),
+    (_beamPath, '_matmul', 'matrix'),
+    (_beamPath, '_matinv', 'matrix'),
+    (_beamq.beamq, 'transformValue', 'matrix'),
+    (_component.componentList, 'combine', 'matrix'),
+    (_component.componentList, 'combineBatch', 'matrix'),
+    (_beamq.beamq, '__init__', 'beamq'),
+    (_beamq.beamq, 'duplicate', 'duplicate'),
+    (_beamPath.beamPath, 'duplicate', 'duplicate'),
+    (_component.componentList, 'duplicate', 'duplicate'),
+]
+
+_active = None
+
+
+class propagationStats(object):
+
+    """
+    -- propagationStats --
+
+        Call counters and accumulated times for each propagation stage,
+        filled in while a profile() block is active.
+
+        Properties:
+            calls - dictionary of call counts, keyed by stage.
+            seconds - dictionary of accumulated time in seconds, keyed by stage.
+            wall - total time spent inside the profile() block.
+
+        Methods:
+            report - returns the statistics as a printable table.
+            display - prints the report.
+    """
+
+    def __init__(self):
+
+        self.calls = {}
+        self.seconds = {}
+        self.wall = 0.
+
+
+    def record(self, stage, dt):
+
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+        self.seconds[stage] = self.seconds.get(stage, 0.) + dt
+
+
+    def report(self):
+
+        lines = [' stage      '+'  calls '+'   total(s) '+'   per call(us)',
+                 ' -----      '+'  ----- '+'   -------- '+'   ------------']
+
+        for stage in sorted(self.seconds, key = self.seconds.get, reverse = True):
+            n = self.calls[stage]
+            t = self.seconds[stage]
+            lines.append(' %-10s %7d %11.6f %14.3f' % (stage, n, t, 1e6*t/n))
+
+        lines.append(' wall time %.6f s' % self.wall)
+        return '\n'.join(lines)
+
+
+    def display(self):
+
+        print (self.report())
+
+
+
+def _timed(func, stage, stats):
+
+    clock = time.perf_counter
+
+    @wraps(func)
+    def timed(*args, **kwargs):
+        t0 = clock()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stats.record(stage, clock()-t0)
+
+    return timed
+
+
+
+@contextmanager
+def profile():
+
+    # -- profiling.profile --
+    #
+    #    Installs timing wrappers around the propagation stages for the
+    #    duration of the with block and yields a propagationStats object.
+    #    The original methods are restored on exit, so there is no cost when
+    #    profiling is not active.
+    #    Example:
+    #    with profiling.profile() as stats:
+    #        path1.qPropagate(zlist)
+    #    stats.display()
+
+    global _active
+
+    if _active is not None:
+        raise Exception ("A profile() block is already active.")
+
+    stats = propagationStats()
+    originals = []
+
+    for owner, name, stage in _hooks:
+        raw = owner.__dict__[name]
+        if isinstance(raw, staticmethod):
+            patched = staticmethod(_timed(raw.__func__, stage, stats))
+        else:
+            patched = _timed(raw, stage, stats)
+        originals.append((owner, name, raw))
+        setattr(owner, name, patched)
+
+    _active = stats
+    t0 = time.perf_counter()
+    try:
+        yield stats
+    finally:
+        stats.wall = time.perf_counter()-t0
+        for owner, name, raw in originals:
+            setattr(owner, name, raw)
+        _active = None
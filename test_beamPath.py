@@ -0,0 +1,278 @@
+import random
+from copy import deepcopy
+
+import numpy as np
+from beamq import beamq
+from component import component
+from beamPath import beamPath, _nondominated
+from pathNetwork import pathNetwork
+
+
+# Regression check for the propagation cache of beamPath (invalidate,
+# _extendCache, branchPath): random edit sequences are applied to a path, and
+# after every edit the propagated beam is compared with a naive propagation
+# which walks the components one np.matrix at a time.
+
+
+def _naiveq(path, zprobe):
+
+    # q at each z in zprobe, propagating the seed through the components in
+    # (min, max] of z and seedz, one matrix at a time; a beam at a component's
+    # position is just downstream of it.
+
+    comps = sorted(path.components_raw, key = lambda c: np.ravel(c.z)[0])
+    steps = [(np.ravel(c.z)[0], c.M.tolist(), c.M.I.tolist()) for c in comps]
+    qout = []
+
+    for z in zprobe:
+        q = complex(path.seedq.q)
+        zcur = path.seedz
+        if z >= zcur:
+            walk = [(zc, M) for zc, M, Minv in steps if zcur < zc <= z]
+        else:
+            walk = [(zc, Minv) for zc, M, Minv in steps if z < zc <= zcur][::-1]
+
+        for zc, M in walk:
+            q = q + (zc-zcur)
+            q = (M[0][0]*q+M[0][1])/(M[1][0]*q+M[1][1])
+            zcur = zc
+        qout.append(q + (z-zcur))
+
+    return np.array(qout)
+
+
+def _check(path, zprobe):
+
+    expected = _naiveq(path, zprobe)
+    assert np.allclose(path.qPropagate(zprobe).q, expected, rtol = 1e-9, atol = 1e-12)
+
+    # the scalar fast path, at a component position and in between
+    for z, q in zip(zprobe[::7], expected[::7]):
+        assert np.isclose(path.qPropagate(z).q, q, rtol = 1e-9, atol = 1e-12)
+
+
+def _randomEdit(path, rng, labels):
+
+    label = rng.choice(labels)
+    r = rng.random()
+
+    if r < 0.35:
+        # small moves mostly stay between neighbours, large ones reorder
+        path.moveComponent(label, rng.choice([1e-3, 0.05, 0.6])*rng.uniform(-1, 1))
+    elif r < 0.45:
+        path.moveComponent(label, rng.uniform(-1, 1), 'absolute')
+    elif r < 0.55:
+        path.replaceCompnent(label, component.lens([rng.uniform(0.3, 2)]))
+    elif r < 0.65 and len(labels) > 2:
+        path.deleteComponent(label)
+        labels.remove(label)
+    elif r < 0.75:
+        new = 'N%d' % rng.randrange(10**6)
+        path.addComponent(component.lens([rng.choice([-1, 1])*rng.uniform(0.3, 2)],
+                                         [rng.uniform(-1, 1)], [new]))
+        labels.append(new)
+    elif r < 0.85:
+        path.seedz = rng.uniform(-1, 1)
+    else:
+        # edit a component object by hand, then tell the path
+        c = path.component(label)
+        zold = np.ravel(c.z)[0]
+        c.z = [rng.uniform(-1, 1)]
+        path.invalidate(min(zold, c.z[0]), max(zold, c.z[0]))
+
+
+def test_cache_matches_naive_propagation():
+
+    rng = random.Random(1)
+    zprobe = np.concatenate([np.linspace(-1.3, 1.3, 53), [0.]])
+
+    for sequence in range(300):
+        seed = beamq.beamWaistAandZ(rng.uniform(1e-4, 5e-4), rng.uniform(-0.5, 0.5))
+        path = beamPath(seed, rng.uniform(-0.5, 0.5), seed, 1.)
+        labels = []
+        for j in range(rng.randrange(0, 10)):
+            labels.append('L%d' % j)
+            path.addComponent(component.lens([rng.choice([-1, 1])*rng.uniform(0.3, 2)],
+                                             [rng.uniform(-1, 1)], [labels[-1]]))
+        _check(path, zprobe)
+
+        for edit in range(6):
+            if labels:
+                _randomEdit(path, rng, labels)
+            _check(path, np.concatenate([zprobe, [np.ravel(c.z)[0] for c in path.components]]))
+
+        # a branch reuses the cached products of its parent
+        branch = path.branchPath(rng.uniform(-1, 1))
+        _check(branch, zprobe)
+        if labels:
+            _randomEdit(branch, rng, list(labels))
+            _check(branch, zprobe)
+        _check(path, zprobe)
+
+
+def test_edit_keeps_cache_on_other_side_of_seed():
+
+    seed = beamq.beamWaistAandZ(3e-4, 0)
+    path = beamPath(seed, 0, seed, 1.)
+    for j in range(1, 21):
+        path.addComponent(component.lens([1.], [0.1*j], ['L%d' % j]))
+        path.addComponent(component.lens([1.], [-0.1*j], ['L-%d' % j]))
+    path.qPropagate(0.5)
+
+    path.moveComponent('L15', 0.01)
+    assert (len(path._fwd), len(path._bwd)) == (14, 20)
+    path.qPropagate(0.5)
+
+    path.moveComponent('L-15', 0.01)
+    assert (len(path._fwd), len(path._bwd)) == (20, 14)
+
+
+def test_ensemble_matches_qPropagate():
+
+    rng = np.random.default_rng(2)
+    seed = beamq.beamWaistAandZ(3e-4, 0.1)
+
+    for ncomps in [0, 1, 4]:
+        path = beamPath(seed, 0.2, seed, 1.)
+        labels = ['L%d' % j for j in range(ncomps)]
+        for j, label in enumerate(labels):
+            path.addComponent(component.lens([rng.uniform(0.3, 2)], [rng.uniform(-1, 1)], [label]))
+
+        positions = rng.uniform(-1, 1, (20, ncomps))
+        zout = rng.uniform(-1.5, 1.5, 20)
+        q = path.propagateEnsemble(positions, zout, labels).q
+
+        for j in range(20):
+            for label, z in zip(labels, positions[j]):
+                path.moveComponent(label, z, 'absolute')
+            assert np.isclose(q[j], path.qPropagate(zout[j]).q, rtol = 1e-9, atol = 1e-12)
+
+
+def test_paretoSearch_returns_nondominated_front():
+
+    F = np.random.default_rng(3).random((2000, 3))
+    brute = [not np.any(np.all(F <= f, 1) & np.any(F < f, 1)) for f in F]
+    assert np.array_equal(_nondominated(F, block = 61), brute)
+
+    seed = beamq.beamWaistAandZ(3e-4, 0)
+    path = beamPath(seed, 0, beamq.beamWaistAandZ(1e-4, 0), 1.5)
+    path.addComponent(component.lens([0.5], [0.4], ['l1']))
+    path.addComponent(component.lens([0.3], [0.9], ['l2']))
+
+    front = path.paretoSearch(['l1', 'l2'], [0, 0.4], [0.8, 1.4], population = 2000,
+                              generations = 3, archiveSize = 100, seed = 0)
+    assert len(front) == 100
+    assert np.all(np.diff(front.overlap) <= 0)
+    F = np.stack([-front.overlap, front.sensitivity, front.length], 1)
+    assert np.all(_nondominated(F))
+
+    # nothing to move but the target, on a path without components
+    empty = beamPath(seed, 0, beamq.beamWaistAandZ(1e-4, 1.), 1.)
+    front = empty.paretoSearch([], [0.5], [2.], moveTarget = True, population = 200,
+                               generations = 2, seed = 0)
+    assert np.all(front.sensitivity == 0)
+    assert np.allclose(front.length, front.z[:, 0])
+
+
+def test_ensemble_default_labels_with_unlabelled_components():
+
+    seed = beamq.beamWaistAandZ(3e-4, 0)
+    path = beamPath(seed, 0, seed, 1.5)
+    path.addComponent(component.lens([0.5], [0.4]))
+    path.addComponent(component.lens([0.3], [0.9]))
+
+    q = path.propagateEnsemble([[0.3, 1.0]], 1.5).q
+
+    comps = path.components
+    comps[0].z, comps[1].z = [0.3], [1.0]
+    path.invalidate()
+    assert np.isclose(q[0], path.qPropagate(1.5).q, rtol = 1e-9)
+
+    # both components are labelled 'no label', so they cannot be told apart
+    try:
+        path.propagateEnsemble([[0.3, 1.0]], 1.5, ['no label', 'no label'])
+    except Exception as e:
+        assert 'not unique' in str(e)
+    else:
+        raise AssertionError ("repeated labels were accepted")
+
+
+def test_pathNetwork_arms_follow_trunk():
+
+    seed = beamq.beamWaistAandZ(3e-4, 0)
+    trunk = beamPath(seed, 0, seed, 2.)
+    trunk.addComponent(component.lens([0.8], [0.3], ['t1']))
+    trunk.addComponent(component.lens([-1.], [0.7], ['t2']))
+    trunk.addComponent(component.lens([0.5], [1.2], ['t3']))
+
+    net = pathNetwork(trunk)
+    arm1 = net.addArm('arm1', 0.5, components = [component.lens([0.4], [0.9], ['a1'])],
+                      targetq = seed, targetz = 1.8)
+    arm2 = net.addArm('arm2', 0.8, components = [component.lens([0.6], [1.1], ['b1'])])
+    arm3 = net.addArm('arm3', 1.0, parent = 'arm1',
+                      components = [component.lens([0.7], [1.4], ['c1'])])
+    zprobe = np.linspace(1.0, 2.0, 11)
+
+    def flat(chain):
+        # one path holding the components each path in chain contributes
+        # (trunk first), up to the next branch point
+        comps = []
+        for (path, zfrom), (child, zto) in zip(chain, chain[1:] + [(None, np.inf)]):
+            comps += [deepcopy(c) for c in path.components if zfrom < np.ravel(c.z)[0] <= zto]
+        return beamPath(trunk.seedq, trunk.seedz, None, 0, comps)
+
+    def check():
+        for name, chain in [('arm1', [(trunk, -np.inf), (arm1, 0.5)]),
+                            ('arm2', [(trunk, -np.inf), (arm2, 0.8)]),
+                            ('arm3', [(trunk, -np.inf), (arm1, 0.5), (arm3, 1.0)])]:
+            assert np.allclose(net.qPropagate(name, zprobe).q, flat(chain).qPropagate(zprobe).q,
+                               rtol = 1e-9)
+
+    check()
+    assert set(net.targetOverlaps()) == {'trunk', 'arm1'}
+
+    # a trunk edit re-seeds every arm, but keeps the arms' own cached products
+    cached = len(arm1._fwd), len(arm2._fwd)
+    trunk.moveComponent('t1', 0.05)
+    check()
+    assert (len(arm1._fwd), len(arm2._fwd)) == cached
+
+    # an arm edit leaves the trunk and the sibling arm alone, but reaches
+    # the arm branching from it
+    versions = trunk.stateVersion, arm2.stateVersion
+    q3 = arm3.qPropagate(1.5).q
+    arm1.moveComponent('a1', 0.05)
+    assert (trunk.stateVersion, arm2.stateVersion) == versions
+    assert arm3.qPropagate(1.5).q != q3
+    check()
+
+    # a copy of an arm stays linked to the live trunk
+    copy1 = arm1.duplicate()
+    assert copy1.parent is trunk
+    trunk.moveComponent('t2', -0.05)
+    assert np.allclose(copy1.qPropagate(zprobe).q, arm1.qPropagate(zprobe).q, rtol = 1e-9)
+
+
+def test_waists_match_beamWidth_scan():
+
+    # seed between components, and a waist upstream of every component
+    seed = beamq.beamWaistAandZ(2e-4, -0.1)
+    path = beamPath(seed, 0.7, seed, 2.)
+    for j, (f, z) in enumerate([(0.15, 0.2), (0.2, 0.5), (0.25, 0.9), (-0.3, 1.3), (0.2, 1.7)]):
+        path.addComponent(component.lens([f], [z], ['L%d' % (j+1)]))
+
+    w = path.waists()
+    assert w.z[0] < 0.2 and w.segment[0] == -1 and w.label[0] == ''
+
+    # local minima of a dense scan, away from the kinks at the lenses
+    z = np.arange(-0.6, 2.6, 1e-5)
+    width = path.qPropagate(z).beamWidth
+    i = np.flatnonzero((width[1:-1] < width[:-2]) & (width[1:-1] <= width[2:])) + 1
+    zc = np.array([np.ravel(c.z)[0] for c in path.components])
+    i = [k for k in i if np.min(np.abs(zc-z[k])) > 3e-5]
+
+    assert len(w) == len(i)
+    assert np.allclose(w.z, z[i], rtol = 0, atol = 2e-5)
+    assert np.allclose(w.waistSize, width[i], rtol = 1e-6)
+    assert np.array_equal(w.segment, path.findSegment(w.z))
+    assert list(w.label) == ['' if s < 0 else path.components[s].label for s in w.segment]
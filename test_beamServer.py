@@ -0,0 +1,126 @@
+import asyncio
+import json
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from beamServer import beamServer, beamClient
+
+
+# These tests run beamServer on a local socket (port 0) and talk to it
+# through beamClient, or through a raw connection for malformed requests.
+
+_create = {'name': 'p1', 'seed': {'w0': 3e-4, 'z': 0}, 'seedz': 0,
+           'target': {'w0': 1e-4, 'z': 1.5}, 'targetz': 1.5,
+           'components': [{'type': 'lens', 'focalLength': 0.5, 'z': 0.4, 'label': 'l1'},
+                          {'type': 'lens', 'focalLength': 0.3, 'z': 0.9, 'label': 'l2'}]}
+
+
+def _run(test, **kwargs):
+
+    async def main():
+        server = beamServer(**kwargs)
+        host, port = await server.start('127.0.0.1', 0)
+        client = await beamClient.connect(host, port)
+        try:
+            await client.call('create', **_create)
+            await test(server, client, host, port)
+        finally:
+            await client.close()
+            await server.close()
+
+    asyncio.run(main())
+
+
+def test_concurrent_propagate_shares_one_batch():
+
+    async def test(server, client, host, port):
+        zs = [0.1, [0.2, 0.3], 1.0, [[-0.5, 1.5]]]
+        results = await asyncio.gather(*[client.call('propagate', name = 'p1', z = z) for z in zs])
+
+        assert server.batchCount == 1
+        path = server.paths['p1']
+        for z, result in zip(zs, results):
+            q = np.asarray(result['q']).view(complex)[..., 0]
+            assert q.shape == np.shape(z)
+            assert np.allclose(q, path.qPropagate(z).q)
+
+    _run(test, batchWindow = 0.05)
+
+
+def test_error_replies():
+
+    async def test(server, client, host, port):
+        for op, kwargs, error in [('nosuchop', {}, 'Unknown op'),
+                                  ('propagate', {'name': 'p2', 'z': 0}, 'No beam path'),
+                                  ('move', {'name': 'p1', 'label': 'l9', 'displacement': 0.1},
+                                   'No component')]:
+            try:
+                await client.call(op, **kwargs)
+            except Exception as e:
+                assert error in str(e)
+            else:
+                raise AssertionError ("%s did not fail" % op)
+
+        # malformed lines still get a reply, and the connection keeps working
+        reader, writer = await asyncio.open_connection(host, port)
+        for line in [b'not json\n', b'[1, 2]\n', b'"op"\n']:
+            writer.write(line)
+            reply = json.loads(await asyncio.wait_for(reader.readline(), 5))
+            assert not reply['ok'] and reply['error'].startswith('bad request')
+        writer.write(b'{"id": 7, "op": "list"}\n')
+        reply = json.loads(await asyncio.wait_for(reader.readline(), 5))
+        assert reply == {'id': 7, 'ok': True, 'result': ['p1']}
+        writer.close()
+
+    _run(test)
+
+
+def test_optimize_apply_refused_after_concurrent_edit():
+
+    # one worker, held by gate.wait, so the optimization only starts once the
+    # move below has been answered
+    executor = ThreadPoolExecutor(1)
+    gate = threading.Event()
+    executor.submit(gate.wait)
+
+    async def test(server, client, host, port):
+        optimize = asyncio.ensure_future(client.call('optimize', name = 'p1', labels = ['l1', 'l2'],
+                                                     lowerBounds = [0, 0.5], upperBounds = [0.5, 1.4],
+                                                     apply = True))
+        await asyncio.sleep(0.05)
+        await client.call('move', name = 'p1', label = 'l1', displacement = 0.01)
+        path = server.paths['p1']
+        gate.set()
+
+        try:
+            await optimize
+        except Exception as e:
+            assert 'not applied' in str(e)
+        else:
+            raise AssertionError ("optimize applied over a concurrent edit")
+        assert server.paths['p1'] is path
+
+        # without a concurrent edit the result is applied
+        result = await client.call('optimize', name = 'p1', labels = ['l1', 'l2'],
+                                   lowerBounds = [0, 0.5], upperBounds = [0.5, 1.4], apply = True)
+        assert server.paths['p1'] is not path
+        assert np.isclose(server.paths['p1'].targetOverlap, result['overlap'])
+
+    _run(test, executor = executor)
+
+
+def test_optimize_in_default_process_pool():
+
+    # the default executor spawns worker processes, so the path and
+    # _optimize have to pickle and import cleanly in a fresh interpreter
+    async def test(server, client, host, port):
+        result = await client.call('optimize', name = 'p1', labels = ['l1', 'l2'],
+                                   lowerBounds = [0, 0.5], upperBounds = [0.5, 1.4])
+        local = server.paths['p1'].optimizePath(['l1', 'l2'], [0, 0.5], [0.5, 1.4])
+
+        assert isinstance(server.executor, ProcessPoolExecutor)
+        assert np.allclose(result['z'], [local.component('l1').z, local.component('l2').z])
+        assert np.isclose(result['overlap'], local.targetOverlap)
+
+    _run(test)
@@ -0,0 +1,94 @@
+import tracemalloc
+
+import numpy as np
+from beamq import beamq
+from component import component
+from beamPath import beamPath
+
+
+def _randomq(rng, n):
+
+    return rng.uniform(-1, 1, n) + 1j*rng.uniform(0.05, 1, n)
+
+
+def test_overlapMatrix_matches_overlap():
+
+    rng = np.random.default_rng(0)
+    q1 = _randomq(rng, 12).reshape(3, 4)
+    q2 = _randomq(rng, 5)
+    M2a = rng.uniform(1, 3, (3, 4))
+
+    for m2a, m2b in [(1, 1), (M2a, 1.5)]:
+        beams1 = beamq(q1, M2 = m2a)
+        beams2 = beamq(q2, M2 = m2b)
+        eta = beamq.overlapMatrix(beams1, beams2)
+        assert eta.shape == (3, 4, 5)
+
+        for i in np.ndindex(q1.shape):
+            for j in range(len(q2)):
+                b1 = beamq(q1[i], M2 = np.broadcast_to(m2a, q1.shape)[i])
+                b2 = beamq(q2[j], M2 = m2b)
+                assert np.isclose(eta[i + (j,)], b1.overlap(b1, b2), rtol = 1e-12)
+
+        # chunked, and written into a preallocated array
+        out = np.empty((3, 4, 5))
+        chunked = beamq.overlapMatrix(beams1, beams2, maxBytes = 1, out = out)
+        assert chunked is out
+        assert np.allclose(chunked, eta, rtol = 1e-14)
+
+
+def test_overlapMatrix_respects_maxBytes():
+
+    rng = np.random.default_rng(1)
+    q1 = _randomq(rng, 1000)
+    q2 = _randomq(rng, 1000)
+    out = np.empty((1000, 1000))
+    maxBytes = 2**22
+
+    for M2a in [1, rng.uniform(1, 3, 1000)]:
+        tracemalloc.start()
+        beamq.overlapMatrix(q1, q2, maxBytes = maxBytes, out = out, M2a = M2a)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert peak <= maxBytes
+
+
+def test_M2_scales_sizes_not_rayleighRange():
+
+    q = np.array([0.3+0.02j, -0.1+0.5j])
+    m = 2.5
+    ideal = beamq(q)
+    real = beamq(q, M2 = m)
+
+    for name in ['beamWidth', 'waistSize', 'divergenceAngle']:
+        assert np.allclose(getattr(real, name), np.sqrt(m)*getattr(ideal, name), rtol = 1e-12)
+    assert np.allclose(real.rayleighRange, q.imag, rtol = 1e-12)
+    assert np.allclose(ideal.rayleighRange, q.imag, rtol = 1e-12)
+
+    # sizes given to the constructors are those of the real beam
+    assert np.isclose(beamq.beamWaistAandZ(3e-4, 0.4, M2 = m).waistSize, 3e-4, rtol = 1e-12)
+    assert np.isclose(beamq.beamWaistAandR(3e-4, 0.4, M2 = m).beamWidth, 3e-4, rtol = 1e-12)
+
+
+def test_M2_is_carried_through_propagation():
+
+    m = 1.7
+    seed = beamq.beamWaistAandZ(3e-4, 0.1, M2 = m)
+    assert seed.transform(np.matrix([[1, 0], [-2, 1]])).M2 == m
+    assert seed.duplicate().M2 == m
+
+    path = beamPath(seed, 0, seed, 1.)
+    path.addComponent(component.lens([0.5], [0.4], ['l1']))
+    assert path.qPropagate(0.8).M2 == m
+    assert path.qPropagate(np.linspace(-1, 1, 5)).M2 == m
+
+
+def test_M2_overlap():
+
+    q = 0.2+0.3j
+    for m in [1, 1.5, 3]:
+        beam = beamq(q, M2 = m)
+        assert np.isclose(beam.overlap(beam, beam), 1, rtol = 1e-12)
+        # the same embedded gaussian coupled into a TEM00 target
+        assert np.isclose(beam.overlap(beam, beamq(q)), (1./m)**2, rtol = 1e-12)
+        assert np.isclose(beamq.overlapMatrix(beam, beamq(q)), (1./m)**2, rtol = 1e-12)
@@ -0,0 +1,69 @@
+import numpy as np
+import profiling
+from beamq import beamq
+from component import component, componentList
+from beamPath import beamPath
+
+
+def _originals():
+
+    return [(owner, name, owner.__dict__[name]) for owner, name, stage in profiling._hooks]
+
+
+def _restored(originals):
+
+    return all(owner.__dict__[name] is raw for owner, name, raw in originals)
+
+
+def test_profile_records_every_stage():
+
+    originals = _originals()
+    seed = beamq.beamWaistAandZ(3e-4, 0)
+    path = beamPath(seed, 0.5, seed, 1.5)
+    path.addComponent(component.lens([0.5], [0.4], ['l1']))
+    path.addComponent(component.lens([0.3], [0.9], ['l2']))
+
+    with beamPath.profile() as stats:
+        path.qPropagate(1.2)
+        path.qPropagate(np.linspace(0, 2, 5))
+        path.moveComponent('l1', 0.7, 'absolute')
+        path.qPropagate(0.2)
+        path.inverseMatrix(path.components[0].M)
+        beamq.transformValue(seed.q, path.components[0].M)
+        componentList(path.components).combine()
+        path.propagateEnsemble([[0.3, 1.0]], 1.5)
+        path.duplicate()
+        seed.duplicate()
+
+    stages = set(stage for owner, name, stage in profiling._hooks)
+    assert set(stats.calls) == stages
+    assert all(stats.calls[stage] > 0 and stats.seconds[stage] >= 0 for stage in stages)
+    assert stats.wall >= stats.seconds['propagate']
+    assert 'propagate' in stats.report()
+    assert _restored(originals)
+
+
+def test_profile_restores_methods_after_exception():
+
+    originals = _originals()
+
+    try:
+        with profiling.profile():
+            assert not _restored(originals)
+            raise ValueError ("inside the block")
+    except ValueError:
+        pass
+
+    assert _restored(originals)
+    assert profiling._active is None
+
+    # a new profile can be started afterwards, but not nested
+    with profiling.profile():
+        try:
+            with profiling.profile():
+                pass
+        except Exception as e:
+            assert 'already active' in str(e)
+        else:
+            raise AssertionError ("nested profile() was accepted")
+    assert _restored(originals)